@@ -0,0 +1,163 @@
+"""PDF text extraction for uploaded client profiles.
+
+PyMuPDF does not support use from multiple threads, so parallel extraction runs in worker
+processes that execute this file (see `serve`). They are plain subprocesses on purpose:
+multiprocessing children re-import the parent's __main__, which under `streamlit run` is the whole
+app. MuPDF is only imported inside the workers; the Streamlit process never loads it.
+"""
+
+import atexit
+import concurrent.futures
+import os
+import queue
+import struct
+import subprocess
+import sys
+import threading
+
+# Keep reading a little past the cap so the caller's slice ends on real text
+OVERREAD_CHARS = 1024
+
+_REQUEST = struct.Struct("<II")  # max_chars, PDF size in bytes; the PDF follows
+_RESPONSE = struct.Struct("<?I")  # ok, payload size; UTF-8 text (or the error message) follows
+
+
+class WorkerError(RuntimeError):
+    """A PDF could not be extracted: unreadable file or a crashed worker."""
+
+
+def warm_up() -> None:
+    """Load the MuPDF bindings in a worker ahead of the first upload."""
+    import fitz  # noqa: F401
+
+
+def extract_text(content: bytes, max_chars: int) -> str:
+    """Extract a PDF's text page by page, stopping shortly after max_chars is reached."""
+    import fitz
+
+    # Plain text without whitespace preservation; hyphenated line breaks are joined
+    flags = fitz.TEXT_DEHYPHENATE | fitz.TEXT_MEDIABOX_CLIP
+    parts: list[str] = []
+    total = 0
+    with fitz.open(stream=content, filetype="pdf") as doc:  # closed promptly to free MuPDF buffers
+        for page in doc:
+            text = page.get_text("text", flags=flags)
+            parts.append(text)
+            total += len(text)
+            if total >= max_chars + OVERREAD_CHARS:
+                break
+    return "".join(parts)
+
+
+def serve() -> None:
+    """Worker loop: answer framed extraction requests on stdin until it is closed."""
+    stdin = sys.stdin.buffer
+    # Keep the protocol stream to ourselves; anything else printed goes to stderr
+    stdout = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    warm_up()
+    while len(header := stdin.read(_REQUEST.size)) == _REQUEST.size:
+        max_chars, size = _REQUEST.unpack(header)
+        content = stdin.read(size)
+        try:
+            ok, payload = True, extract_text(content, max_chars).encode("utf-8", "replace")
+        except Exception as e:  # noqa: BLE001
+            ok, payload = False, f"{type(e).__name__}: {e}".encode("utf-8", "replace")
+        stdout.write(_RESPONSE.pack(ok, len(payload)) + payload)
+        stdout.flush()
+
+
+class WorkerPool:
+    """Warm extraction workers, each used by one thread at a time.
+
+    Workers start (and load MuPDF) when the pool is created. One that dies, or is killed for
+    running past its request's timeout, is replaced on the next request, so a crash or hang
+    only fails the file that caused it.
+    """
+
+    def __init__(self, size: int) -> None:
+        self._idle: "queue.Queue[subprocess.Popen[bytes] | None]" = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._spawn())
+        self._threads = concurrent.futures.ThreadPoolExecutor(size, thread_name_prefix="pdf-text")
+        atexit.register(self.close)
+
+    @staticmethod
+    def _spawn() -> "subprocess.Popen[bytes]":
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+
+    @staticmethod
+    def _discard(proc: "subprocess.Popen[bytes]") -> None:
+        proc.kill()
+        proc.wait()
+        for pipe in (proc.stdin, proc.stdout):
+            if pipe is not None:
+                pipe.close()
+
+    def submit(self, content: bytes, max_chars: int, timeout: float) -> "concurrent.futures.Future[str]":
+        """Queue a PDF for extraction.
+
+        The future raises WorkerError if the file cannot be read, or TimeoutError if a worker
+        spends more than `timeout` seconds on it (that worker is killed).
+        """
+        return self._threads.submit(self._extract, content, max_chars, timeout)
+
+    def _extract(self, content: bytes, max_chars: int, timeout: float) -> str:
+        proc = self._idle.get()
+        if proc is None or proc.poll() is not None:
+            proc = self._spawn()
+        timed_out = threading.Event()
+
+        def expire() -> None:
+            timed_out.set()
+            proc.kill()  # unblocks the reads below
+
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+        try:
+            assert proc.stdin is not None and proc.stdout is not None
+            proc.stdin.write(_REQUEST.pack(max_chars, len(content)))
+            proc.stdin.write(content)
+            proc.stdin.flush()
+            header = proc.stdout.read(_RESPONSE.size)
+            if len(header) < _RESPONSE.size:
+                raise WorkerError("the PDF worker exited unexpectedly")
+            ok, size = _RESPONSE.unpack(header)
+            payload = proc.stdout.read(size)
+            if len(payload) < size:
+                raise WorkerError("the PDF worker exited unexpectedly")
+        except BaseException as e:
+            self._discard(proc)  # never reuse a worker left mid-request
+            proc = None
+            if isinstance(e, (OSError, WorkerError)) and timed_out.is_set():
+                raise TimeoutError(f"PDF extraction took longer than {timeout:.0f}s") from e
+            if isinstance(e, OSError):
+                raise WorkerError(f"the PDF worker failed ({e})") from e
+            raise
+        finally:
+            timer.cancel()
+            self._idle.put(proc)
+        if not ok:
+            raise WorkerError(payload.decode("utf-8", "replace"))
+        return payload.decode("utf-8", "replace")
+
+    def close(self) -> None:
+        """Let queued work finish, then stop the workers (they exit when stdin closes)."""
+        self._threads.shutdown(wait=True)
+        while True:
+            try:
+                proc = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if proc is not None and proc.stdin is not None:
+                proc.stdin.close()
+                try:
+                    proc.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self._discard(proc)
+
+
+if __name__ == "__main__":
+    serve()
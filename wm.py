@@ -1,73 +1,440 @@
+import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
 import os
-from typing import List, Dict, Any
+import queue
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Awaitable, Iterator
+from typing import Any, TypeVar
 from uuid import uuid4
 
-import requests
+import aiohttp
+import httpx
+import ijson
 import streamlit as st
-from openai import OpenAI
+import tiktoken
+import xxhash
+from markdown_it import MarkdownIt
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, RateLimitError
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    stop_after_delay,
+    wait_random_exponential,
+)
+
+import pdf_text
 
 # ==================== Config ====================
 st.set_page_config(page_title="Orion | Wealth Management Assistant", page_icon="💬", layout="centered")
 
 MODEL = "gpt-4o"
 TEMPERATURE = 0.9
+OPP_TEMPERATURE = 0  # the Opportunities report is deterministic so it can be cached
+OPP_SEED = 42  # best-effort server-side reproducibility for the report
+OPP_CONCURRENCY = 3  # report sections in flight at once; each carries the full system prefix
 MAX_REPLY_CHARS = 4000
+MAX_REPLY_TOKENS = 1000  # server-side cap (max_tokens), ~MAX_REPLY_CHARS of English text
+STREAM_IDLE_TIMEOUT = 30  # seconds without a chunk before a stream is treated as hung
+MAX_PROFILE_CHARS = 12000  # text extracted per uploaded PDF; raise if you like
+MAX_PROFILE_TOKENS = 3000  # per session profile appended to the system prefix (~MAX_PROFILE_CHARS)
+MAX_SESSION_PROFILE_TOKENS = 6000  # all session profiles together; further uploads are refused
+MIN_PROFILE_TOKENS = 200  # a profile cut shorter than this isn't worth adding
+PDF_WORKERS = min(4, os.cpu_count() or 1)  # processes for parallel PDF text extraction
+PDF_EXTRACT_TIMEOUT = 30  # seconds per file; a worker stuck longer is killed and replaced
+# Per OpenAI request; a read stalls no longer than a stream may idle, so a hang fails in ~30 s
+REQUEST_TIMEOUT = httpx.Timeout(connect=5, read=STREAM_IDLE_TIMEOUT, write=10, pool=5)
+LIVE_CONTEXT_TIMEOUT = 3  # seconds; live web context is best-effort and must not hold up replies
+PROMPT_CACHE_KEY = "orion-wm-v1"  # sticky routing for OpenAI prompt caching; bump with the prompt
+MAX_HISTORY_TURNS = 12  # user/assistant exchanges sent per request (plus the first turn)
+MAX_HISTORY_TOKENS = 1500  # ~6000 chars of history on top of the system prompt
+RETRY_BUDGET = 20  # seconds of automatic retries (rate limits, dropped connections) per request
+RATE_LIMIT_RPM = 3500  # process-wide OpenAI throttle (requests / tokens per minute)
+RATE_LIMIT_TPM = 90000
+# Per-session memory bounds: messages are ~1–4 KB, so ~100 KB/chat × 25 chats ≈ 2.5 MB/session
+MAX_CHATS = 25  # older chats are archived to disk
+MAX_MESSAGES = 200  # per chat; the API window is far smaller, the rest is only UI scrollback
+RECENT_MESSAGES = 30  # rendered inline; older ones are paged inside an expander
+HISTORY_PAGE_SIZE = 30
+# Chats hold client details: on-disk state lives in a private (0700) per-user directory
+ORION_DATA_DIR = os.path.join(os.path.expanduser("~"), ".cache", "orion")
+CHAT_ARCHIVE_DIR = os.path.join(ORION_DATA_DIR, "chats")  # evicted chats; pruned like the logs
+PROFILE_CACHE_DIR = os.path.join(ORION_DATA_DIR, "profiles")  # extracted PDF text by content hash
+PROFILE_CACHE_MAX_BYTES = 50 * 1024 * 1024  # oldest entries are evicted beyond this
+PROFILE_CACHE_TTL = 30 * 24 * 3600  # seconds
+CHAT_LOG_DIR = os.path.join(ORION_DATA_DIR, "chat-logs")  # append-only message log
+CHAT_LOG_ENABLED = os.getenv("ORION_CHAT_LOG", "") == "1"  # opt-in
+CHAT_LOG_MAX_BYTES = 5 * 1024 * 1024  # per file; the previous file is kept as <name>.1
+CHAT_LOG_RETENTION = 7 * 24 * 3600  # seconds; older files are deleted
+
+T = TypeVar("T")
+
+logger = logging.getLogger("orion")
 
 # ==================== Helpers ====================
 @st.cache_resource(show_spinner=False)
-def _get_openai_client() -> OpenAI:
-    """Create a single OpenAI client for the app lifecycle."""
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """Run one background event loop shared by every session for OpenAI I/O."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="orion-asyncio", daemon=True).start()
+    return loop
+
+
+def _submit_async(coro: Awaitable[T]) -> "concurrent.futures.Future[T]":
+    """Schedule a coroutine on the shared loop without waiting for it."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop())
+
+
+def _run_async(coro: Awaitable[T]) -> T:
+    """Run a coroutine on the shared loop and block the script thread until it finishes."""
+    return _submit_async(coro).result()
+
+
+def _iter_async(agen: AsyncIterator[T]) -> Iterator[T]:
+    """Drive an async iterator on the shared loop, yielding its items synchronously."""
+    try:
+        while True:
+            try:
+                yield _run_async(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        aclose = getattr(agen, "aclose", None)
+        if aclose is not None:
+            _run_async(aclose())
+
+
+class TokenBucket:
+    """Async token-bucket throttle for OpenAI's requests-per-minute and tokens-per-minute limits.
+
+    Runs on the shared event loop, so waiting callers yield instead of blocking other sessions.
+    """
+
+    def __init__(self, rpm: int, tpm: int) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self._updated = now - self._updated, now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until one request and `tokens` tokens are available, then consume them."""
+        tokens = min(tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep(
+                    max((1 - self._requests) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm)
+                )
+
+
+@st.cache_resource(show_spinner=False)
+def _get_rate_limiter() -> TokenBucket:
+    """Process-wide throttle shared by all sessions."""
+    return TokenBucket(rpm=RATE_LIMIT_RPM, tpm=RATE_LIMIT_TPM)
+
+
+@st.cache_resource(show_spinner=False)
+def _create_openai_client(key_hash: str, _api_key: str) -> AsyncOpenAI:
+    """Create one async OpenAI client (and keep-alive HTTP/2 pool) per API key.
+
+    The cache is keyed on `key_hash`; the leading underscore keeps the raw key out of it.
+    """
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+    )
+    # Retries are handled by _complete (with backoff), so disable the SDK's own retry loop
+    return AsyncOpenAI(api_key=_api_key, http_client=http_client, max_retries=0)
+
+
+def _get_openai_client() -> AsyncOpenAI:
+    """Return the cached OpenAI client, stopping the script if no API key is configured.
+
+    The key is looked up (environment first, then st.secrets) and hashed once per session; later
+    reruns reuse the client stored in session state.
+    """
+    client = st.session_state.get("_openai_client")
+    if client is not None:
+        return client
     api_key = os.getenv("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY")  # type: ignore[attr-defined]
     if not api_key:
         st.error("Missing OPENAI_API_KEY. Add it to environment or st.secrets.")
         st.stop()
-    return OpenAI(api_key=api_key)
+    client = _create_openai_client(hashlib.sha256(api_key.encode()).hexdigest(), api_key)
+    st.session_state._openai_client = client
+    return client
+
+
+@st.cache_resource(show_spinner=False)
+def _get_encoding() -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(MODEL)
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Trim text to at most max_tokens model tokens."""
+    enc = _get_encoding()
+    ids = enc.encode(text)
+    return enc.decode(ids[:max_tokens]) if len(ids) > max_tokens else text
+
+
+def _count_tokens(text: str) -> int:
+    return len(_get_encoding().encode(text))
+
+
+def _estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 chars per token) for budgeting requests."""
+    return len(text) // 4
+
+
+# Timeouts are not retried here: a hung request already cost REQUEST_TIMEOUT, so it is surfaced
+# right away with a manual Retry instead (APITimeoutError subclasses APIConnectionError)
+@retry(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError))
+    & retry_if_not_exception_type(APITimeoutError),
+    wait=wait_random_exponential(min=1, max=8),
+    stop=stop_after_attempt(4) | stop_after_delay(RETRY_BUDGET),
+    reraise=True,
+)
+async def _complete(
+    client: AsyncOpenAI, limiter: TokenBucket, messages: list[dict[str, Any]], **kwargs: Any
+) -> Any:
+    """Await a chat completion, throttled by `limiter` and retried on transient errors."""
+    await limiter.acquire(sum(_estimate_tokens(m["content"]) for m in messages) + MAX_REPLY_TOKENS)
+    return await client.chat.completions.create(
+        model=MODEL,
+        messages=messages,
+        max_tokens=MAX_REPLY_TOKENS,  # stop generating server-side instead of truncating afterwards
+        timeout=REQUEST_TIMEOUT,
+        extra_body={"prompt_cache_key": PROMPT_CACHE_KEY},
+        **kwargs,
+    )
+
+
+async def _astream_text(
+    client: AsyncOpenAI,
+    limiter: TokenBucket,
+    messages: list[dict[str, Any]],
+    max_chars: int = MAX_REPLY_CHARS,
+    temperature: float = TEMPERATURE,
+    seed: int | None = None,
+) -> AsyncIterator[str]:
+    """Yield reply deltas from a streamed completion, stopping once max_chars is reached.
+
+    The stream is closed on exit (including the early cutoff) so OpenAI stops generating, and a
+    gap of more than STREAM_IDLE_TIMEOUT seconds between chunks is raised as a TimeoutError.
+    """
+    kwargs: dict[str, Any] = {"seed": seed} if seed is not None else {}
+    stream = await _complete(client, limiter, messages, temperature=temperature, stream=True, **kwargs)
+    chunks = stream.__aiter__()
+    total = 0
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), STREAM_IDLE_TIMEOUT)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise TimeoutError(
+                    f"no tokens received for {time.monotonic() - started:.0f}s; the model may be stalled"
+                ) from None
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if not delta:
+                continue
+            if total + len(delta) >= max_chars:
+                yield delta[: max_chars - total]
+                return
+            total += len(delta)
+            yield delta
+    finally:
+        await stream.close()
+
+
+def _stream_reply(
+    client: AsyncOpenAI,
+    messages: list[dict[str, Any]],
+    max_chars: int = MAX_REPLY_CHARS,
+    temperature: float = TEMPERATURE,
+) -> Iterator[str]:
+    """Synchronous view of _astream_text for st.write_stream."""
+    return _iter_async(_astream_text(client, _get_rate_limiter(), messages, max_chars, temperature))
+
+
+_STREAM_END = object()
+
+
+def _prefetch(
+    agen: AsyncIterator[T], limit: asyncio.Semaphore | None = None
+) -> tuple[Iterator[T], "concurrent.futures.Future[None]"]:
+    """Start draining an async iterator on the shared loop now; read its buffered items later.
+
+    Lets several streams run concurrently (at most `limit` at once) while the script thread
+    renders them one at a time. Errors are re-raised on the reading side. Returns the reader and
+    the pump's future: cancel the future to stop the stream, even if it was never read.
+    """
+    buffer: "queue.Queue[Any]" = queue.Queue()
+
+    async def pump() -> None:
+        try:
+            async with limit or contextlib.nullcontext():
+                async for item in agen:
+                    buffer.put(item)
+        except Exception as e:  # noqa: BLE001
+            buffer.put(e)
+        finally:
+            buffer.put(_STREAM_END)
+
+    future = _submit_async(pump())
+
+    def read() -> Iterator[T]:
+        try:
+            while (item := buffer.get()) is not _STREAM_END:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+    return read(), future
+
+
+class ReplyCache:
+    """Thread-safe LRU of finished replies with a TTL, shared by all sessions."""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
 
+    @staticmethod
+    def key(messages: list[dict[str, Any]], temperature: float, seed: int | None = None) -> str:
+        """Key on the model, sampling settings and the full request (system prompt included)."""
+        payload = json.dumps([MODEL, temperature, seed, messages], sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
 
-def _truncate(text: str, max_chars: int = MAX_REPLY_CHARS) -> str:
-    return text if len(text) <= max_chars else text[:max_chars]
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if time.monotonic() - item[0] > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item[1]
 
+    def put(self, key: str, reply: str) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic(), reply)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
 
-def _build_messages(system_prompt: str, history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Build messages for the API, stripping UI-only metadata keys."""
-    msgs: List[Dict[str, str]] = [{"role": "system", "content": system_prompt}]
-    for m in history:
-        role = m.get("role", "user")
-        content = m.get("content", "")
-        if not content:
-            continue
-        msgs.append({"role": role, "content": content})
-    return msgs
 
+@st.cache_resource(show_spinner=False)
+def _get_reply_cache() -> ReplyCache:
+    return ReplyCache()
+
+
+def _build_messages(
+    system_messages: list[dict[str, str]], turns: list[dict[str, str]]
+) -> list[dict[str, Any]]:
+    """Build a request from the system prefix and a chat's API-ready turns.
+
+    `turns` is the chat's "api_messages" list (see _append_message), already stripped of UI
+    metadata, so only the window is touched: the first exchange (who we are helping) is always
+    kept, followed by the last MAX_HISTORY_TURNS exchanges, with the oldest user/assistant pairs
+    dropped until the estimate fits MAX_HISTORY_TOKENS. The window always starts on a user turn,
+    so a reply is never sent without the question it answers.
+    """
+    head = turns[:2] if len(turns) > 1 and turns[1]["role"] == "assistant" else turns[:1]
+    rest = turns[len(head):]
+    start = max(0, len(rest) - (MAX_HISTORY_TURNS * 2 - 1))
+    while start < len(rest) and rest[start]["role"] != "user":
+        start += 1
+    tail = rest[start:]
+    tokens = sum(_estimate_tokens(m["content"]) for m in head + tail)
+    while len(tail) > 2 and tail[1]["role"] == "assistant" and tokens > MAX_HISTORY_TOKENS:
+        tokens -= _estimate_tokens(tail[0]["content"]) + _estimate_tokens(tail[1]["content"])
+        del tail[:2]
+    return [*system_messages, *head, *tail]
+
+
+@st.cache_resource(show_spinner=False)
+def _get_http_session() -> aiohttp.ClientSession:
+    """One aiohttp session, owned by the shared loop, reused by every live-context lookup."""
+
+    async def create() -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=LIVE_CONTEXT_TIMEOUT))
 
-def get_realtime_context(query: str, max_results: int = 3) -> str:
+    return _run_async(create())
+
+
+async def get_realtime_context(
+    session: aiohttp.ClientSession, query: str, max_results: int = 3
+) -> str | None:
     """Fetch short summaries of live data using DuckDuckGo's Instant Answer API.
-    This is optional context and will fail closed (returns a note) if the request fails.
+    This is optional context: returns None when there is nothing to add, logging (never
+    returning) the error if the request fails, so internal details stay out of the prompt.
     """
     try:
-        res = requests.get(
+        abstract: str | None = None
+        topics: list[str] = []
+        seen = 0
+        async with session.get(
             "https://api.duckduckgo.com/",
             params={"q": query, "format": "json", "no_redirect": 1, "no_html": 1},
-            timeout=8,
-        )
-        data = res.json()
-        snippets = []
-
-        if data.get("AbstractText"):
-            snippets.append(data["AbstractText"])
-        for topic in data.get("RelatedTopics", [])[:max_results]:
-            if isinstance(topic, dict) and topic.get("Text"):
-                snippets.append(topic["Text"])
+        ) as res:
+            # Stream-parse only the fields we use and stop reading once we have them; DDG puts
+            # AbstractText before RelatedTopics, and aiohttp already requests gzip.
+            async for prefix, event, value in ijson.parse_async(res.content):
+                if prefix == "AbstractText" and event == "string":
+                    abstract = value
+                elif prefix == "RelatedTopics.item" and event == "start_map":
+                    seen += 1
+                    if seen > max_results and abstract is not None:
+                        break
+                elif prefix == "RelatedTopics.item.Text" and event == "string" and seen <= max_results:
+                    if value:
+                        topics.append(value)
+                elif prefix == "RelatedTopics" and event == "end_array" and abstract is not None:
+                    break
+        snippets = [abstract, *topics] if abstract else topics
 
         if snippets:
             return "\n".join(snippets)
-    except Exception as e:  # noqa: BLE001
-        return f"(Live data unavailable: {e})"
+    except Exception:  # noqa: BLE001
+        logger.warning("Live context lookup failed", exc_info=True)
 
-    return "(No live results found.)"
+    return None
 
 
 # ==================== Base System Prompt ====================
+# DO NOT INTERPOLATE — breaks OpenAI prompt cache. Volatile content (dates, names) belongs in the user turn.
 BASE_SYSTEM_PROMPT = (
     "You are an AI Wealth Manager Assistant called Orion. You assist a dedicated Wealth Manager Executive "
     "in ensuring clients under their portfolio are well taken care of with ample details. "
@@ -119,6 +486,53 @@ BASE_SYSTEM_PROMPT = (
     "Lastly, when asked for recommendations, be direct and straightforward and give exact locations or services."
 )
 
+# Guard the cached prefix: update this digest deliberately whenever the prompt text is edited
+assert hashlib.sha256(BASE_SYSTEM_PROMPT.encode()).hexdigest() == (
+    "fd4073a32c8c8072b99c1b4d8b341dc1e5d6d640f1b437bd9670c2dacf316e31"
+), "BASE_SYSTEM_PROMPT changed; update the digest (and PROMPT_CACHE_KEY) on purpose"
+
+# Prebuilt (immutable) system message; always the first entry of every request
+_BASE_SYSTEM_MSG = ({"role": "system", "content": BASE_SYSTEM_PROMPT},)
+
+
+def _build_system_messages() -> list[dict[str, str]]:
+    """System prefix: the frozen base prompt, then session profiles as a second message.
+
+    Profiles keep upload order (dicts preserve insertion order) and each one is capped when it
+    is added (see _fit_profile), so an upload only appends to the prefix: earlier profiles are
+    never cut off or shifted, and OpenAI's prefix cache keeps hitting for them.
+    """
+    profs = st.session_state.get("client_profiles", {})
+    if not profs:
+        return [_BASE_SYSTEM_MSG[0]]
+    joined = "\n\n".join(profs.values())
+    profiles_msg = {"role": "system", "content": f"# Additional Client Profiles (session)\n{joined}"}
+    return [_BASE_SYSTEM_MSG[0], profiles_msg]
+
+
+def _profile_tokens_left() -> int:
+    """Tokens of MAX_SESSION_PROFILE_TOKENS not yet used by this session's profiles."""
+    used = sum(_count_tokens(p) for p in st.session_state.get("client_profiles", {}).values())
+    return MAX_SESSION_PROFILE_TOKENS - used
+
+
+def _fit_profile(entry: str, tokens_left: int) -> str | None:
+    """Cap a profile entry to MAX_PROFILE_TOKENS and the session budget still left.
+
+    Only the new entry is cut, never the ones already in the prefix; None once the budget is
+    (nearly) used up.
+    """
+    limit = min(MAX_PROFILE_TOKENS, tokens_left)
+    if limit < MIN_PROFILE_TOKENS:
+        return None
+    return _truncate(entry, limit)
+
+
+def _refresh_system_messages() -> None:
+    """Recompute the cached system prefix; call whenever client_profiles changes."""
+    st.session_state._system_messages = _build_system_messages()
+
+
 # ==================== Seeded Opportunities Prompt ====================
 OPP_PROMPT = (
     "Identify and summarize recent exclusive opportunities that may be of strong interest to any clients in your portfolio, based on their profiles, life milestones, and stated interests."
@@ -138,213 +552,654 @@ OPP_PROMPT = (
     "If no relevant opportunities are found for a client, state no opportunities as of now."
 )
 
-# ==================== Session State Init ====================
-if "theme" not in st.session_state:
-    st.session_state.theme = "Light"
-
-if "client_profiles" not in st.session_state:
-    st.session_state.client_profiles = []
-if "client_profile_hashes" not in st.session_state:   # prevent duplicates
-    st.session_state.client_profile_hashes = set()
-if "uploader_version" not in st.session_state:        # lets us clear uploader selection
-    st.session_state.uploader_version = 0
-
-if "chats" not in st.session_state:
-    st.session_state.chats = {}
-if "active_chat" not in st.session_state:
-    new_id = str(uuid4())
-    st.session_state.chats[new_id] = {"name": "Chat #1", "messages": []}
-    st.session_state.active_chat = new_id
+# Clients in BASE_SYSTEM_PROMPT, in profile order; the report is one request per client
+OPP_CLIENTS = ("Alexandra Wu-Chan", "Luca Bianchi", "Charles Montgomery IV", "Noor Al-Fulan", "Kenji Tanaka")
+OPP_SESSION_CLIENTS = "the clients under \"Additional Client Profiles (session)\""
+
+
+def _build_opportunity_requests(system_messages: list[dict[str, str]]) -> list[list[dict[str, Any]]]:
+    """One request per client (plus one for session profiles), fanned out by _render_report.
+
+    Each shares the system prefix and OPP_PROMPT, so only the closing focus line differs.
+    """
+    clients = list(OPP_CLIENTS)
+    if st.session_state.get("client_profiles"):
+        clients.append(OPP_SESSION_CLIENTS)
+    return [
+        [*system_messages, {
+            "role": "user",
+            "content": f"{OPP_PROMPT}\nFor this reply, cover only {name}; the other clients are handled separately.",
+        }]
+        for name in clients
+    ]
+
+# ==================== Styles ====================
+SIDEBAR_CSS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sidebar.css")
+SIDEBAR_LOGO_HTML = """
+<div style="text-align: center; margin-top: -20px; margin-bottom: 20px;">
+    <img src="https://i.gyazo.com/737ba90e6e261129b45c099fa1b68c52.png"
+         style="width: 120px; display: block; margin: auto;" />
+</div>
+"""
+
+
+@st.cache_resource(show_spinner=False)
+def _sidebar_html() -> str:
+    """Logo plus the sidebar stylesheet as one static block, read from disk once per process."""
+    with open(SIDEBAR_CSS_PATH, encoding="utf-8") as fh:
+        return f"{SIDEBAR_LOGO_HTML}<style>\n{fh.read()}</style>"
+
+
+# ==================== Client Profiles ====================
+@st.cache_resource(show_spinner=False)
+def _get_pdf_pool() -> pdf_text.WorkerPool:
+    """Worker processes for PDF extraction, shared by all sessions (see pdf_text.py).
+
+    Started once per process at app boot (below _ensure_session), so MuPDF is already loaded in
+    every worker by the first upload. Workers run pdf_text.py directly and never import the app.
+    """
+    return pdf_text.WorkerPool(PDF_WORKERS)
+
+
+def _profile_cache_key(content: bytes) -> str:
+    """Cryptographic key for the shared text cache, so a crafted PDF can't collide with another's."""
+    return hashlib.blake2b(content, digest_size=32).hexdigest()
+
+
+def _profile_cache_path(cache_key: str) -> str:
+    # Extraction stops near MAX_PROFILE_CHARS, so the limit is part of the key
+    return os.path.join(PROFILE_CACHE_DIR, f"{cache_key}-{MAX_PROFILE_CHARS}.txt")
+
+
+def _load_cached_profile(cache_key: str) -> str | None:
+    """Return previously extracted text for this PDF (from any session), if on disk and fresh."""
+    path = _profile_cache_path(cache_key)
+    try:
+        if time.time() - os.path.getmtime(path) > PROFILE_CACHE_TTL:
+            return None
+        with open(path, encoding="utf-8") as fh:
+            return fh.read()
+    except OSError:
+        return None
+
+
+def _store_cached_profile(cache_key: str, text: str) -> None:
+    """Persist extracted text so re-uploads skip MuPDF; best-effort, written atomically.
+
+    Files are private (mkstemp creates them 0600, in a 0700 directory), and the cache is
+    trimmed to PROFILE_CACHE_TTL and PROFILE_CACHE_MAX_BYTES, oldest first.
+    """
+    try:
+        _private_dir(PROFILE_CACHE_DIR)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=PROFILE_CACHE_DIR, delete=False) as fh:
+            fh.write(text)
+        os.replace(fh.name, _profile_cache_path(cache_key))
+        _prune_profile_cache()
+    except OSError:
+        pass
+
+
+def _prune_profile_cache() -> None:
+    now = time.time()
+    with os.scandir(PROFILE_CACHE_DIR) as entries:
+        files = sorted(
+            ((e.stat().st_mtime, e.stat().st_size, e.path) for e in entries if e.is_file()), reverse=True
+        )
+    total = 0
+    for mtime, size, path in files:  # newest first
+        total += size
+        if now - mtime > PROFILE_CACHE_TTL or total > PROFILE_CACHE_MAX_BYTES:
+            os.unlink(path)
+
+
+# ==================== Chat Store ====================
+class ChatLogEngine:
+    """Background writer that batches jsonl appends off the Streamlit script thread.
+
+    Lines are flushed once `max_batch` are pending or `flush_interval` seconds have passed,
+    with one open/write per file per batch instead of one per message. Directories are created
+    0700 and files 0600; a file over `max_bytes` is rotated to "<path>.1", and files untouched
+    for `retention` seconds are deleted (checked at most hourly per directory).
+    """
+
+    def __init__(
+        self,
+        max_batch: int = 32,
+        flush_interval: float = 0.05,
+        max_bytes: int = CHAT_LOG_MAX_BYTES,
+        retention: float = CHAT_LOG_RETENTION,
+    ) -> None:
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self._pruned: dict[str, float] = {}  # directory -> last prune time
+        self._queue: "queue.Queue[tuple[str, str]]" = queue.Queue()
+        threading.Thread(target=self._run, name="orion-chatlog", daemon=True).start()
+        atexit.register(self.flush)
+
+    def append(self, path: str, line: str) -> None:
+        """Queue `line` (newline-terminated) for appending to `path`."""
+        self._queue.put((path, line))
+
+    def flush(self) -> None:
+        """Write whatever is queued right now (used at interpreter exit)."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._write(batch)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
 
-# Ensure a persistent, non-deletable Opportunities tab exists
-if "opps_chat_id" not in st.session_state:
+    def _write(self, batch: list[tuple[str, str]]) -> None:
+        by_path: dict[str, list[str]] = {}
+        for path, line in batch:
+            by_path.setdefault(path, []).append(line)
+        for path, lines in by_path.items():
+            try:
+                _private_dir(os.path.dirname(path))
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                with open(fd, "a", encoding="utf-8") as fh:
+                    fh.writelines(lines)
+                    size = fh.tell()
+                if size > self.max_bytes:
+                    os.replace(path, f"{path}.1")
+                self._prune(os.path.dirname(path))
+            except OSError:
+                pass  # persistence is best-effort; never break the chat over it
+
+    def _prune(self, directory: str) -> None:
+        now = time.time()
+        if now - self._pruned.get(directory, 0) < 3600:
+            return
+        self._pruned[directory] = now
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and now - entry.stat().st_mtime > self.retention:
+                    os.unlink(entry.path)
+
+
+def _private_dir(path: str) -> None:
+    """Create `path` (and ORION_DATA_DIR above it) readable by the current user only."""
+    for directory in (ORION_DATA_DIR, path):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        os.chmod(directory, 0o700)  # makedirs leaves existing directories' modes alone
+
+
+@st.cache_resource(show_spinner=False)
+def _get_chat_log() -> ChatLogEngine:
+    """Process-wide batching writer shared by all sessions."""
+    return ChatLogEngine()
+
+
+def _archive_chat(chat_id: str, chat: dict[str, Any]) -> None:
+    """Append an evicted chat to this session's private jsonl archive (kept CHAT_LOG_RETENTION)."""
+    path = os.path.join(CHAT_ARCHIVE_DIR, f"{st.session_state.session_id}.jsonl")
+    record = {"id": chat_id, **{k: v for k, v in chat.items() if k != "api_messages"}}
+    _get_chat_log().append(path, json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _add_chat(chat_id: str, chat: dict[str, Any]) -> None:
+    """Register a chat, archiving the oldest ones (never pinned/active) beyond MAX_CHATS."""
+    chats = st.session_state.chats
+    chat.setdefault("api_messages", [])  # role/content turns, appended alongside "messages"
+    chats[chat_id] = chat
+    protected = {chat_id, st.session_state.get("opps_chat_id"), st.session_state.get("active_chat")}
+    while len(chats) > MAX_CHATS:
+        oldest = next((cid for cid in chats if cid not in protected), None)
+        if oldest is None:
+            break
+        _archive_chat(oldest, chats.pop(oldest))
+
+
+@st.cache_resource(show_spinner=False)
+def _get_markdown() -> MarkdownIt:
+    """CommonMark (+ GFM tables/strikethrough) renderer, matching how st.markdown shows replies.
+
+    Raw HTML in user or model text is escaped rather than passed through to st.html.
+    """
+    return MarkdownIt("commonmark", {"html": False}).enable(["table", "strikethrough"])
+
+
+def _next_chat_name() -> str:
+    """Number chats from a per-session counter, so names stay unique after eviction/deletion."""
+    st.session_state.chat_counter = st.session_state.get("chat_counter", len(st.session_state.chats)) + 1
+    return f"Chat #{st.session_state.chat_counter}"
+
+
+def _api_messages(chat: dict[str, Any]) -> list[dict[str, str]]:
+    """The chat's API-ready turns, rebuilt from "messages" for chats that predate the list."""
+    if "api_messages" not in chat:
+        turns = [
+            {"role": m.get("role", "user"), "content": m["content"]}
+            for m in chat.get("messages", [])
+            if m.get("content") and not m.get("meta", {}).get("error")
+        ]
+        chat["api_messages"] = turns[:2] + turns[2:][-(MAX_HISTORY_TURNS * 2):]
+    return chat["api_messages"]
+
+
+def _assistant_message(reply: str, ok: bool) -> dict[str, Any]:
+    """Message for a rendered reply; failed ones are marked so they never reach the API."""
+    message: dict[str, Any] = {"role": "assistant", "content": reply}
+    if not ok:
+        message["meta"] = {"error": True}
+    return message
+
+
+def _append_message(chat_id: str, message: dict[str, Any]) -> None:
+    """Append a message, dropping the oldest pair beyond MAX_MESSAGES.
+
+    With CHAT_LOG_ENABLED the message is also appended to this session's on-disk log.
+
+    The API-ready copy goes to "api_messages", which keeps the first exchange plus just enough
+    recent ones for the _build_messages window, so requests never re-walk the whole history.
+    """
+    chat = st.session_state.chats[chat_id]
+    if CHAT_LOG_ENABLED:
+        path = os.path.join(CHAT_LOG_DIR, f"{st.session_state.session_id}.jsonl")
+        record = {"chat_id": chat_id, "ts": time.time(), **message}
+        _get_chat_log().append(path, json.dumps(record, ensure_ascii=False) + "\n")
+    # Parse Markdown once here so history reruns can skip the parser (see _render_message)
+    message["html"] = _get_markdown().render(message.get("content", ""))
+    chat["messages"].append(message)
+    if len(chat["messages"]) > MAX_MESSAGES:
+        del chat["messages"][:2]
+    if message.get("content") and not message.get("meta", {}).get("error"):
+        api_messages = _api_messages(chat)
+        api_messages.append({"role": message.get("role", "user"), "content": message["content"]})
+        if len(api_messages) > MAX_HISTORY_TURNS * 2 + 2:
+            del api_messages[2:4]  # the oldest pair after the first exchange
+
+
+def _add_opps_chat() -> str:
+    """Create the pinned, non-deletable Recommendations chat and return its id."""
     opps_id = str(uuid4())
     st.session_state.opps_chat_id = opps_id
-    st.session_state.chats[opps_id] = {
+    _add_chat(opps_id, {
         "name": "Recommendations",
         "messages": [],
         "meta": {"pinned": True, "system": "opportunities"},
-    }
+    })
+    st.session_state.chats.move_to_end(opps_id, last=False)  # pinned tab is always first
+    return opps_id
 
-# ==================== Sidebar ====================
-with st.sidebar:
-    st.markdown(
-        """
-        <div style="text-align: center; margin-top: -20px; margin-bottom: 20px;">
-            <img src="https://i.gyazo.com/737ba90e6e261129b45c099fa1b68c52.png"
-                 style="width: 120px; display: block; margin: auto;" />
-        </div>
-        """,
-        unsafe_allow_html=True,
-    )
 
-    # 🔎 Recommendations (navigate to pinned tab; does not create a new chat)
-    if st.button("🔎 Recommendations", key="opps_btn"):
-    # Remove the old Recommendations tab if it exists
-        if "opps_chat_id" in st.session_state:
-            old_id = st.session_state.opps_chat_id
-            if old_id in st.session_state.chats:
-                del st.session_state.chats[old_id]
+# ==================== Session State Init ====================
+def _ensure_session() -> None:
+    """Initialise per-session state on the first run (no-op on reruns)."""
+    if "theme" not in st.session_state:
+        st.session_state.theme = "Light"
 
-        # Create a new Recommendations chat
-        new_id = str(uuid4())
-        st.session_state.opps_chat_id = new_id
-        st.session_state.chats[new_id] = {
-            "name": "Recommendations",
-            "messages": [],
-            "meta": {"pinned": True, "system": "opportunities"},
-        }
+    if "client_profiles" not in st.session_state:       # content hash -> profile text, upload order
+        st.session_state.client_profiles = {}
+    elif isinstance(st.session_state.client_profiles, list):  # sessions from before the dict
+        legacy, st.session_state.client_profiles = st.session_state.client_profiles, {}
+        tokens_left = MAX_SESSION_PROFILE_TOKENS
+        for i, text in enumerate(legacy):
+            entry = _fit_profile(text, tokens_left)
+            if entry is None:
+                break
+            st.session_state.client_profiles[f"legacy-{i}"] = entry
+            tokens_left -= _count_tokens(entry)
+        _refresh_system_messages()
+    st.session_state.pop("client_profile_hashes", None)  # superseded by client_profiles' keys
+    if "uploader_version" not in st.session_state:        # lets us clear uploader selection
+        st.session_state.uploader_version = 0
+    if "_system_messages" not in st.session_state:       # system prefix sent with every request
+        _refresh_system_messages()
 
-        # Set it active and trigger auto-generation
-        st.session_state.active_chat = new_id
-        st.session_state.autorun = True
-        st.rerun()
+    if "session_id" not in st.session_state:             # keys the on-disk chat archive
+        st.session_state.session_id = str(uuid4())
 
-    # ➕ New Chat
-    if st.button("➕ New Chat", key="new_chat_btn"):
+    if "chats" not in st.session_state:
+        st.session_state.chats = OrderedDict()
+    else:  # sessions from before the OrderedDict store hold a plain dict with "Chat #1" first
+        chats = st.session_state.chats
+        opps_id = st.session_state.get("opps_chat_id")
+        if not isinstance(chats, OrderedDict) or (opps_id in chats and next(iter(chats)) != opps_id):
+            chats = st.session_state.chats = OrderedDict(chats)
+            if opps_id in chats:
+                chats.move_to_end(opps_id, last=False)  # pinned tab is always first
+    if "active_chat" not in st.session_state:
         new_id = str(uuid4())
-        name = f"Chat #{len(st.session_state.chats) + 1}"
-        st.session_state.chats[new_id] = {"name": name, "messages": []}
+        _add_chat(new_id, {"name": _next_chat_name(), "messages": []})
         st.session_state.active_chat = new_id
-        st.rerun()
 
-    # Chat list (pinned Opportunities first, non-deletable)
+    # Ensure a persistent, non-deletable Opportunities tab exists
+    if "opps_chat_id" not in st.session_state:
+        _add_opps_chat()
+
+
+_ensure_session()
+_get_pdf_pool()  # once per process: boot PDF workers before anyone uploads
+
+# ==================== UI Callbacks ====================
+# Sidebar actions run as widget callbacks, i.e. before the rerun their click triggers, so the
+# UI reflects them in that single run instead of needing a second st.rerun().
+def _open_recommendations() -> None:
+    """Replace the pinned Recommendations tab with a fresh one and queue its report."""
+    old_id = st.session_state.get("opps_chat_id")
+    if old_id in st.session_state.chats:
+        del st.session_state.chats[old_id]
+    st.session_state.active_chat = _add_opps_chat()
+    st.session_state.autorun = True
+
+
+def _new_chat() -> None:
+    new_id = str(uuid4())
+    _add_chat(new_id, {"name": _next_chat_name(), "messages": []})
+    st.session_state.active_chat = new_id
+
+
+def _select_chat() -> None:
+    if st.session_state.chat_radio is not None:
+        st.session_state.active_chat = st.session_state.chat_radio
+
+
+def _delete_active_chat() -> None:
+    """Delete the current chat (never the pinned tab) and fall back to another one."""
+    chats = st.session_state.chats
     opps_id = st.session_state.get("opps_chat_id")
+    if st.session_state.active_chat == opps_id:
+        return
+    del chats[st.session_state.active_chat]
+    # fallback to the most recent remaining chat (the pinned tab is first), or start a fresh one
+    next_id = next(reversed(chats)) if len(chats) > 1 else None
+    if next_id is None:
+        next_id = str(uuid4())
+        _add_chat(next_id, {"name": _next_chat_name(), "messages": []})
+    st.session_state.active_chat = next_id
 
-    # Render the rest (deletable)
-    to_delete: List[str] = []
-    for chat_id, chat in list(st.session_state.chats.items()):
-        if chat_id == opps_id:
-            continue
-        cols = st.columns([0.8, 0.2])
-        if cols[0].button(chat["name"], key=f"chat_btn_{chat_id}"):
-            st.session_state.active_chat = chat_id
-            st.rerun()
-        if cols[1].button("🗑", key=f"del_btn_{chat_id}"):
-            to_delete.append(chat_id)
-
-    # Delete selected (never delete the pinned tab)
-    for chat_id in to_delete:
-        if chat_id == opps_id:
-            continue
-        del st.session_state.chats[chat_id]
-        if chat_id == st.session_state.active_chat:
-            # fallback to Opportunities or first remaining
-            next_ids = [cid for cid in st.session_state.chats.keys() if cid != opps_id]
-            if next_ids:
-                st.session_state.active_chat = next_ids[0]
+
+def _wipe_profiles() -> None:
+    st.session_state.client_profiles = {}
+    _refresh_system_messages()
+    st.session_state.uploader_version += 1
+
+
+def _set_history_page(chat_id: str, page: int) -> None:
+    # Runs before the fragment rerun the click triggers, so one run shows the new page
+    st.session_state.setdefault("history_page", {})[chat_id] = page
+
+
+# ==================== UI Components ====================
+def _render_chat_list() -> None:
+    """Render the deletable chats as one radio plus a single delete button (O(1) widgets)."""
+    opps_id = st.session_state.get("opps_chat_id")
+    chats = st.session_state.chats
+    active_id = st.session_state.active_chat
+
+    # Render the rest (deletable; the pinned tab is always first); the radio follows active_chat
+    chat_ids = list(chats)[1:]
+    st.session_state.chat_radio = active_id if active_id in chats and active_id != opps_id else None
+    st.radio(
+        "Chats",
+        options=chat_ids,
+        format_func=lambda cid: chats[cid]["name"],
+        key="chat_radio",
+        on_change=_select_chat,
+        label_visibility="collapsed",
+    )
+    st.button(
+        "🗑 Delete chat", key="del_chat_btn", on_click=_delete_active_chat, disabled=active_id == opps_id
+    )
+
+
+def _render_message(msg: dict[str, Any]) -> None:
+    with st.chat_message(msg.get("role", "assistant")):
+        if "html" in msg:
+            st.html(msg["html"])
+        else:
+            st.markdown(msg.get("content", ""))
+
+
+@st.fragment
+def _render_messages(chat_id: str) -> None:
+    """Render a chat's history (hide seeded/hidden messages).
+
+    Only the last RECENT_MESSAGES are rendered inline; older turns sit in a collapsed expander
+    and are paged HISTORY_PAGE_SIZE at a time, so paging reruns just this fragment.
+    """
+    # Hide UI-only seeded messages
+    messages = st.session_state.chats[chat_id].get("messages", [])
+    visible = [m for m in messages if not m.get("meta", {}).get("hidden")]
+    older, recent = visible[:-RECENT_MESSAGES], visible[-RECENT_MESSAGES:]
+
+    if older:
+        pages = st.session_state.setdefault("history_page", {})
+        last_page = (len(older) - 1) // HISTORY_PAGE_SIZE
+        page = min(pages.get(chat_id, 0), last_page)  # 0 = the batch just before `recent`
+        end = len(older) - page * HISTORY_PAGE_SIZE
+        start = max(0, end - HISTORY_PAGE_SIZE)
+        with st.expander(f"Show earlier messages ({len(older)})"):
+            nav = st.columns(2)
+            if page < last_page:
+                nav[0].button(
+                    "◀ Earlier", key=f"hist_prev_{chat_id}", on_click=_set_history_page, args=(chat_id, page + 1)
+                )
+            if page > 0:
+                nav[1].button(
+                    "Later ▶", key=f"hist_next_{chat_id}", on_click=_set_history_page, args=(chat_id, page - 1)
+                )
+            for msg in older[start:end]:
+                _render_message(msg)
+
+    for msg in recent:
+        _render_message(msg)
+
+
+def _write_reply(stream: Iterator[str], cache_key: str | None = None) -> tuple[str, bool]:
+    """Stream a reply into the current container, caching it under `cache_key` on success.
+
+    Returns the shown text and whether it is a real reply (False for the error notes below).
+    """
+    try:
+        reply = st.write_stream(stream)
+    except (APITimeoutError, httpx.TimeoutException, TimeoutError) as e:
+        # Timeouts are never retried automatically; offer the Retry button (see "Retry" below)
+        st.session_state.retry_chat = st.session_state.active_chat
+        reply = f"Error: the request timed out ({e or type(e).__name__})."
+        st.markdown(reply)
+        return reply, False
+    except (RateLimitError, APIConnectionError) as e:
+        # _complete already spent its RETRY_BUDGET on these; hand over to the Retry button
+        st.session_state.retry_chat = st.session_state.active_chat
+        reply = f"Error: OpenAI is unavailable right now ({type(e).__name__}). Please retry."
+        st.markdown(reply)
+        return reply, False
+    except Exception as e:  # noqa: BLE001
+        reply = f"Error: {e}"
+        st.markdown(reply)
+        return reply, False
+    if cache_key:
+        _get_reply_cache().put(cache_key, reply)
+    return reply, True
+
+
+def _render_reply(
+    client: AsyncOpenAI,
+    messages: list[dict[str, Any]],
+    temperature: float = TEMPERATURE,
+    use_cache: bool = False,
+) -> tuple[str, bool]:
+    """Write an assistant reply into the current container; returns (text, ok) as _write_reply.
+
+    With `use_cache` (only sensible at temperature 0) identical requests are answered from the
+    shared ReplyCache; otherwise tokens are streamed as they arrive, capped at MAX_REPLY_CHARS.
+    """
+    cache_key = ReplyCache.key(messages, temperature) if use_cache else None
+    cached = _get_reply_cache().get(cache_key) if cache_key else None
+    if cached is not None:
+        st.markdown(cached)
+        return cached, True
+    return _write_reply(_stream_reply(client, messages, MAX_REPLY_CHARS, temperature), cache_key)
+
+
+def _render_report(
+    client: AsyncOpenAI,
+    requests: list[list[dict[str, Any]]],
+    temperature: float = OPP_TEMPERATURE,
+    seed: int | None = OPP_SEED,
+) -> tuple[str, bool]:
+    """Write one reply per request, all fetched concurrently but shown in request order.
+
+    Returns the joined text and whether every section is a real reply (see _write_reply).
+
+    Cached sections render instantly; the rest stream in parallel, OPP_CONCURRENCY at a time in
+    request order, so the first section appears as soon as its own tokens arrive. If the run
+    ends early (rerun, Stop), every stream not yet finished is cancelled so nothing keeps
+    generating (and billing) into a buffer no one reads.
+    """
+    cache = _get_reply_cache()
+    keys = [ReplyCache.key(messages, temperature, seed) for messages in requests]
+    cached = [cache.get(key) for key in keys]
+    limiter = _get_rate_limiter()
+    limit = asyncio.Semaphore(OPP_CONCURRENCY)
+    streams: dict[int, tuple[Iterator[str], "concurrent.futures.Future[None]"]] = {}
+    try:
+        for i, messages in enumerate(requests):
+            if cached[i] is None:
+                agen = _astream_text(client, limiter, messages, MAX_REPLY_CHARS, temperature, seed)
+                streams[i] = _prefetch(agen, limit)
+        sections = []
+        ok = True
+        for i, key in enumerate(keys):
+            if cached[i] is not None:
+                st.markdown(cached[i])
+                sections.append(cached[i])
             else:
-                new_id = str(uuid4())
-                st.session_state.chats[new_id] = {"name": "Chat #1", "messages": []}
-                st.session_state.active_chat = new_id
-        st.rerun()
+                section, section_ok = _write_reply(streams[i][0], key)
+                sections.append(section)
+                ok = ok and section_ok
+        return "\n\n".join(sections), ok
+    finally:
+        for _, future in streams.values():
+            future.cancel()
+
+
+# ==================== Sidebar ====================
+with st.sidebar:
+    # Logo and all sidebar styling (avoid brittle testid selectors where possible). Streamlit drops
+    # elements a rerun does not re-emit, so this is sent every run, but it never changes.
+    st.markdown(_sidebar_html(), unsafe_allow_html=True)
+
+    # 🔎 Recommendations (replaces the pinned tab with a fresh report)
+    st.button("🔎 Recommendations", key="opps_btn", on_click=_open_recommendations)
+
+    # ➕ New Chat
+    st.button("➕ New Chat", key="new_chat_btn", on_click=_new_chat)
+
+    # Chat list (pinned Opportunities first, non-deletable)
+    _render_chat_list()
 
-    # Styling (avoid brittle testid selectors where possible)
-    st.markdown(
-        f"""
-        <style>
-            .new-chat-btn {{
-                color: red; font-size: 1rem; font-weight: bold; text-align: left;
-                display: block; width: 100%; margin-bottom: 1rem; padding: 8px 12px;
-            }}
-            /* Minimal highlight for active chat via data-key attribute */
-            [data-chat-id="{st.session_state.active_chat}"] {{
-                background-color: #d0d0d0 !important; color: black !important;
-                font-weight: 600 !important; border-radius: 10px !important; border: 2px solid #888 !important;
-            }}
-        </style>
-        """,
-        unsafe_allow_html=True,
+    st.toggle(
+        "🎯 Deterministic replies",
+        key="deterministic",
+        help="Answer at temperature 0 so repeated questions can be served instantly from cache.",
+    )
+    st.toggle(
+        "🌐 Live web context",
+        key="live_context",
+        help="Add DuckDuckGo Instant Answer snippets for each question to the request.",
     )
 
     st.markdown("---")
     st.subheader("📎 Add Client Profile")
 
-    # Custom wrapper to visually simplify the uploader
-    st.markdown(
-        """
-        <style>
-            /* Hide the file name and clear (x) button */
-            .uploadedFile, .stUploadedFile {display: none !important;}
-            .stFileUploader label div[data-testid="stFileUploaderDropzone"] {
-                border: 2px dashed #bbb !important;
-                border-radius: 8px !important;
-                padding: 10px !important;
-                text-align: center !important;
-                color: #555 !important;
-            }
-            .stFileUploader label div[data-testid="stFileUploaderDropzone"]::before {
-                content: "📄 Drop or click to add client profile PDFs";
-                display: block;
-                font-weight: 500;
-            }
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
-
-    # Always-visible uploader (multi-file)
+    # Always-visible uploader (multi-file), until the session's profile budget is used up
+    tokens_left = _profile_tokens_left()
+    budget_full = tokens_left < MIN_PROFILE_TOKENS
+    if budget_full:
+        st.info("Client profile space for this session is full. Wipe the added profiles to upload more.")
     uploaded_pdfs = st.file_uploader(
         label="Upload client PDFs",
         type=["pdf"],
         accept_multiple_files=True,
         key=f"client_pdf_{st.session_state.uploader_version}",
         label_visibility="collapsed",  # hide label to rely on CSS placeholder
+        disabled=budget_full,
     )
 
-    system_prompt = BASE_SYSTEM_PROMPT
-
     if uploaded_pdfs:
-        import hashlib, fitz
+        todo: list[tuple[str, bytes, str]] = []
+        seen = set(st.session_state.client_profiles)  # keyed by content hash, so also the dedupe set
         for f in uploaded_pdfs:
             content = f.read()
-            h = hashlib.md5(content).hexdigest()
-            if h in st.session_state.client_profile_hashes:
+            h = xxhash.xxh3_64_hexdigest(content)  # non-cryptographic; dedupe only
+            if h in seen:
                 continue
+            seen.add(h)
+            todo.append((getattr(f, "name", "a file"), content, h))
+
+        # PDFs seen before (by any session) come from the on-disk text cache; the rest are parsed
+        # in parallel worker processes, since PyMuPDF is not safe to share across threads
+        cache_keys = {h: _profile_cache_key(content) for _, content, h in todo}
+        cached = {h: _load_cached_profile(cache_keys[h]) for _, _, h in todo}
+        pool = _get_pdf_pool()
+        futures = {
+            h: pool.submit(content, MAX_PROFILE_CHARS, PDF_EXTRACT_TIMEOUT)
+            for _, content, h in todo
+            if cached[h] is None
+        }
+
+        # Mutate session_state on the script thread only; failures are reported per file
+        errors = []
+        for name, _, h in todo:
             try:
-                doc = fitz.open(stream=content, filetype="pdf")
-                text = "".join(page.get_text("text") for page in doc).strip()
-                if not text:
+                sanitized = cached[h]
+                if sanitized is None:
+                    # No deadline here: the pool is shared, so queueing time isn't ours to judge, and
+                    # a worker is killed after PDF_EXTRACT_TIMEOUT once it is running the file
+                    text = futures[h].result()
+                    sanitized = text.strip().replace("\x00", "")
+                    _store_cached_profile(cache_keys[h], sanitized)
+                if not sanitized:
                     continue
-                sanitized = text.replace("\x00", "")
-                st.session_state.client_profiles.append(
-                    f"# New Client Profile Added\n---\n{sanitized}\n"
-                )
-                st.session_state.client_profile_hashes.add(h)
+                full = f"# New Client Profile Added\n---\n{sanitized}\n"
+                entry = _fit_profile(full, tokens_left)
+                if entry is None:
+                    errors.append(f"Skipped {name}: client profile space for this session is full.")
+                    continue
+                if len(entry) < len(full) and tokens_left < MAX_PROFILE_TOKENS:
+                    errors.append(f"{name} was shortened to fit the remaining client profile space.")
+                st.session_state.client_profiles[h] = entry
+                tokens_left -= _count_tokens(entry)
+            except TimeoutError:
+                errors.append(f"Failed to process {name}: it took longer than {PDF_EXTRACT_TIMEOUT}s.")
             except Exception as e:
-                st.error(f"Failed to process {getattr(f, 'name', 'a file')}: {e}")
+                errors.append(f"Failed to process {name}: {e}")
+        _refresh_system_messages()
+        st.session_state.upload_errors = errors  # shown after the rerun below
         st.session_state.uploader_version += 1
         st.rerun()
 
-        if added:
-            st.success(f"✅ Added {added} profile(s).")
+    for error in st.session_state.pop("upload_errors", []):
+        st.error(error)
 
     # Controls: wipe all or just clear the current selection UI
-    if st.button("🧹 Wipe New Client Data", key="wipe_clients_btn", use_container_width=True):
-        st.session_state.client_profiles = []
-        st.session_state.client_profile_hashes = set()
-        st.session_state.uploader_version += 1
-        st.rerun()
+    st.button(
+        "🧹 Wipe New Client Data", key="wipe_clients_btn", on_click=_wipe_profiles, use_container_width=True
+    )
 
     st.caption(f"Profiles in session: {len(st.session_state.client_profiles)}")
 
-    if st.session_state.client_profiles:
-        MAX_PROFILE_CHARS = 6000
-        joined = "\n\n".join(st.session_state.client_profiles)
-        system_prompt = f"{BASE_SYSTEM_PROMPT}\n\n# Additional Client Profiles (session)\n{joined[:MAX_PROFILE_CHARS]}"
-    else:
-        system_prompt = BASE_SYSTEM_PROMPT
-
-MAX_PROFILE_CHARS = 12000  # raise if you like
-def _build_system_prompt() -> str:
-    base = BASE_SYSTEM_PROMPT
-    profs = st.session_state.get("client_profiles", [])
-    if profs:
-        joined = "\n\n".join(profs)
-        return f"{base}\n\n# Additional Client Profiles (session)\n{joined[:MAX_PROFILE_CHARS]}"
-    return base
-
-system_prompt = _build_system_prompt()
+system_messages = st.session_state._system_messages  # rebuilt only on profile upload/wipe
 
 # ==================== Main UI ====================
 active_chat_id = st.session_state.active_chat
@@ -353,57 +1208,71 @@ active_chat = st.session_state.chats[active_chat_id]
 st.title("Orion | Wealth Assistant 💬")
 st.caption(f"Chat Name: {active_chat['name']}")
 
-# Render previous messages (hide seeded/hidden messages)
-for msg in active_chat.get("messages", []):
-    # Hide UI-only seeded messages
-    if msg.get("meta", {}).get("hidden"):
-        continue
-    with st.chat_message(msg.get("role", "assistant")):
-        st.markdown(msg.get("content", "")) 
+# Retry after a reply that timed out or ran out of automatic retries: drop it, then ask again below
+retry = bool(st.session_state.get("retry_btn")) and st.session_state.get("retry_chat") == active_chat_id
+if retry:
+    del st.session_state.retry_chat
+    # The failed reply is UI-only (marked meta.error, never in api_messages); the question stays
+    history = active_chat["messages"]
+    if history and history[-1].get("meta", {}).get("error"):
+        history.pop()
+    if active_chat_id == st.session_state.get("opps_chat_id"):
+        st.session_state.autorun = True
+        retry = False
+
+# Render previous messages
+_render_messages(active_chat_id)
 
 # Auto-run the Opportunities prompt only when switching to the pinned tab
 if st.session_state.get("autorun") and active_chat_id == st.session_state.get("opps_chat_id"):
     st.session_state.autorun = False
     client = _get_openai_client()
-    messages = _build_messages(system_prompt, [{"role": "user", "content": OPP_PROMPT}])
-    try:
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            temperature=TEMPERATURE,
-        )
-        reply = _truncate(response.choices[0].message.content or "", MAX_REPLY_CHARS)
-    except Exception as e:  # noqa: BLE001
-        reply = f"Error: {e}"
+    # One deterministic (temperature 0, fixed seed) request per client, so revisits hit the reply cache
     with st.chat_message("assistant"):
-        st.markdown(reply)
+        reply, ok = _render_report(
+            client, _build_opportunity_requests(system_messages), temperature=OPP_TEMPERATURE, seed=OPP_SEED
+        )
     # Persist only the assistant's reply so the tab looks like a regular chat of reports
-    active_chat["messages"].append({"role": "assistant", "content": reply})
+    _append_message(active_chat_id, _assistant_message(reply, ok))
 
 # Input
 user_input = st.chat_input("Type your message…")
 
-if user_input:
-    with st.chat_message("user"):
-        st.markdown(user_input)
-    active_chat["messages"].append({"role": "user", "content": user_input})
+if user_input or retry:
+    st.session_state.pop("retry_chat", None)
+    question = user_input or next(
+        (m["content"] for m in reversed(active_chat["messages"]) if m["role"] == "user"), ""
+    )
+
+    # Start the live lookup first so its round-trip overlaps rendering and request prep
+    live_context = (
+        _submit_async(get_realtime_context(_get_http_session(), question))
+        if st.session_state.get("live_context")
+        else None
+    )
+
+    if user_input:
+        with st.chat_message("user"):
+            st.markdown(user_input)
+        _append_message(active_chat_id, {"role": "user", "content": user_input})
 
     client = _get_openai_client()
 
     # Compose request (optionally enrich with real-time context if desired)
-    messages = _build_messages(system_prompt, active_chat["messages"])  # system + history
+    messages = _build_messages(system_messages, _api_messages(active_chat))  # system + history
+    # Bounded by LIVE_CONTEXT_TIMEOUT; placed just before the question it answers, if any came back
+    live_text = live_context.result() if live_context is not None else None
+    if live_text:
+        messages.insert(-1, {"role": "system", "content": f"Live web context:\n{live_text}"})
 
-    try:
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            temperature=TEMPERATURE,
+    # Deterministic replies (temperature 0) are safe to serve from the shared reply cache
+    deterministic = st.session_state.get("deterministic", False)
+    with st.chat_message("assistant"):
+        reply, ok = _render_reply(
+            client, messages, temperature=0 if deterministic else TEMPERATURE, use_cache=deterministic
         )
-        reply = response.choices[0].message.content or ""
-        reply = _truncate(reply, MAX_REPLY_CHARS)
-    except Exception as e:  # noqa: BLE001
-        reply = f"Error: {e}"
+    _append_message(active_chat_id, _assistant_message(reply, ok))
 
-    with st.chat_message("assistant"):
-        st.markdown(reply)
-    active_chat["messages"].append({"role": "assistant", "content": reply})
+# Offer a retry for the active chat's failed reply (handled at the top of the next run)
+if st.session_state.get("retry_chat") == active_chat_id:
+    st.button("🔁 Retry", key="retry_btn")